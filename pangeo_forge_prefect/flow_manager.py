@@ -1,10 +1,13 @@
-import importlib
+import copy
+import importlib.util
 import logging
+import mmap
 import os
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import timedelta
-from functools import wraps
-from typing import Dict
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
 
 import yaml
 from adlfs import AzureBlobFileSystem
@@ -16,6 +19,7 @@ from pangeo_forge_recipes.storage import CacheFSSpecTarget, FSSpecTarget, Metada
 from prefect import client, storage
 from prefect.executors import DaskExecutor
 from prefect.run_configs import ECSRun, KubernetesRun
+from prefect.utilities.graphql import with_args
 from s3fs import S3FileSystem
 
 from pangeo_forge_prefect.automation_hook_manager import create_automation
@@ -26,18 +30,53 @@ from pangeo_forge_prefect.meta_types.bakery import (
     S3_PROTOCOL,
     Bakery,
     Cluster,
+    Target,
 )
 from pangeo_forge_prefect.meta_types.meta import Meta, RecipeBakery
 from pangeo_forge_prefect.meta_types.versions import Versions
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+logger = logging.getLogger(__name__)
+_YAML_CACHE: Dict[Tuple[str, int, int, Optional[str]], Any] = {}
+
+_AKS_JOB_TEMPLATE = yaml.load(
+    """
+    apiVersion: batch/v1
+    kind: Job
+    metadata:
+      annotations:
+        "cluster-autoscaler.kubernetes.io/safe-to-evict": "false"
+    spec:
+      template:
+        spec:
+          containers:
+            - name: flow
+    """,
+    Loader=SafeLoader,
+)
+
 
 @dataclass
 class Targets:
+    __slots__ = ("target", "cache", "metadata")
+
     target: FSSpecTarget
     cache: CacheFSSpecTarget
     metadata: MetadataTarget
 
 
+@dataclass(frozen=True)
+class ResolvedSecrets:
+    target_key: Optional[str] = None
+    target_secret: Optional[str] = None
+    flow_storage_key: Optional[str] = None
+    flow_storage_secret: Optional[str] = None
+
+
 class UnsupportedTarget(Exception):
     pass
 
@@ -66,204 +105,358 @@ class UnsupportedRecipeType(Exception):
     pass
 
 
-def set_log_level(func):
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        logging.basicConfig()
-        logging.getLogger("pangeo_forge_recipes").setLevel(level=logging.DEBUG)
-        result = func(*args, **kwargs)
-        return result
+def _construct_yaml(stream, key: Optional[str] = None) -> Any:
+    loader = SafeLoader(stream)
+    try:
+        if key is None:
+            return loader.get_single_data()
+        node = loader.get_single_node()
+        if isinstance(node, yaml.MappingNode):
+            # Later duplicate keys win, matching a full load.
+            for key_node, value_node in reversed(node.value):
+                if key_node.value == key:
+                    return loader.construct_document(value_node)
+        raise KeyError(key)
+    finally:
+        loader.dispose()
+
+
+def _load_yaml_cached(path: str, key: Optional[str] = None) -> Any:
+    stat = os.stat(path)
+    cache_key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, key)
+    if cache_key not in _YAML_CACHE:
+        if stat.st_size == 0:
+            # Empty files can't be memory-mapped and contain no document.
+            _YAML_CACHE[cache_key] = _construct_yaml(b"", key)
+        else:
+            with open(path, "rb") as yaml_file, mmap.mmap(
+                yaml_file.fileno(), 0, access=mmap.ACCESS_READ
+            ) as yaml_data:
+                _YAML_CACHE[cache_key] = _construct_yaml(yaml_data, key)
+    return _YAML_CACHE[cache_key]
+
+
+def resolve_secrets(bakery: Bakery, recipe_bakery: RecipeBakery, secrets: Dict) -> ResolvedSecrets:
+    """
+    Look up the secret values referenced by a bakery's target and flow storage.
+
+    Parameters
+    ----------
+    bakery : Bakery
+        The bakery the recipes are registered with
+    recipe_bakery : RecipeBakery
+        The meta.yaml bakery entry selecting the target
+    secrets : dict
+        Secret values keyed by the names used in bakeries.yaml
+    """
+
+    def lookup(name: Optional[str]) -> Optional[str]:
+        return secrets[name] if name is not None else None
+
+    private = bakery.targets[recipe_bakery.target].private
+    target_options = private.storage_options if private is not None else None
+    flow_storage_options = bakery.cluster.flow_storage_options
+    return ResolvedSecrets(
+        target_key=lookup(target_options.key) if target_options else None,
+        target_secret=lookup(target_options.secret) if target_options else None,
+        flow_storage_key=lookup(flow_storage_options.key),
+        flow_storage_secret=lookup(flow_storage_options.secret),
+    )
+
+
+def _make_targets(fs, base_path: str, extension: str) -> Targets:
+    cache_path = f"{base_path}/cache"
+    return Targets(
+        target=FSSpecTarget(fs, f"{base_path}.{extension}"),
+        cache=CacheFSSpecTarget(fs, cache_path),
+        metadata=MetadataTarget(fs, f"{cache_path}/metadata"),
+    )
+
+
+def _s3_targets(
+    target: Target,
+    recipe_bakery: RecipeBakery,
+    recipe_name: str,
+    secrets: ResolvedSecrets,
+    extension: str,
+    repository: str,
+):
+    if target.private.storage_options:
+        fs = S3FileSystem(
+            anon=False,
+            default_cache_type="none",
+            default_fill_cache=False,
+            key=secrets.target_key,
+            secret=secrets.target_secret,
+        )
+        base_path = f"s3://{recipe_bakery.target}/{repository}/{recipe_name}"
+        return _make_targets(fs, base_path, extension)
+
+
+def _abfs_targets(
+    target: Target,
+    recipe_bakery: RecipeBakery,
+    recipe_name: str,
+    secrets: ResolvedSecrets,
+    extension: str,
+    repository: str,
+):
+    if target.private.storage_options:
+        fs = AzureBlobFileSystem(connection_string=secrets.target_secret)
+        base_path = f"abfs://{recipe_bakery.target}/{repository}/{recipe_name}"
+        return _make_targets(fs, base_path, extension)
+
 
-    return wrapper
+_TARGET_BUILDERS = {
+    S3_PROTOCOL: _s3_targets,
+    ABFS_PROTOCOL: _abfs_targets,
+}
 
 
 def configure_targets(
-    bakery: Bakery, recipe_bakery: RecipeBakery, recipe_name: str, secrets: Dict, extension: str
+    bakery: Bakery,
+    recipe_bakery: RecipeBakery,
+    recipe_name: str,
+    secrets: ResolvedSecrets,
+    extension: str,
+    repository: Optional[str] = None,
 ):
     target = bakery.targets[recipe_bakery.target]
-    repository = os.environ["GITHUB_REPOSITORY"]
-    if target.private.protocol == S3_PROTOCOL:
-        if target.private.storage_options:
-            key = secrets[target.private.storage_options.key]
-            secret = secrets[target.private.storage_options.secret]
-            fs = S3FileSystem(
-                anon=False,
-                default_cache_type="none",
-                default_fill_cache=False,
-                key=key,
-                secret=secret,
-            )
-            target_path = f"s3://{recipe_bakery.target}/{repository}/{recipe_name}.{extension}"
-            target = FSSpecTarget(fs, target_path)
-            cache_path = f"s3://{recipe_bakery.target}/{repository}/{recipe_name}/cache"
-            cache_target = CacheFSSpecTarget(fs, cache_path)
-            metadata_path = f"s3://{recipe_bakery.target}/{repository}/{recipe_name}/cache/metadata"
-            metadata_target = MetadataTarget(fs, metadata_path)
-            return Targets(target=target, cache=cache_target, metadata=metadata_target)
-    elif target.private.protocol == ABFS_PROTOCOL:
-        if target.private.storage_options:
-            secret = secrets[target.private.storage_options.secret]
-            fs = AzureBlobFileSystem(connection_string=secret)
-            target_path = f"abfs://{recipe_bakery.target}/{repository}/{recipe_name}.{extension}"
-            target = FSSpecTarget(fs, target_path)
-            cache_path = f"abfs://{recipe_bakery.target}/{repository}/{recipe_name}/cache"
-            cache_target = CacheFSSpecTarget(fs, cache_path)
-            metadata_path = (
-                f"abfs://{recipe_bakery.target}/{repository}/{recipe_name}" "/cache/metadata"
-            )
-            metadata_target = MetadataTarget(fs, metadata_path)
-            return Targets(target=target, cache=cache_target, metadata=metadata_target)
-    else:
+    if repository is None:
+        repository = os.environ["GITHUB_REPOSITORY"]
+    try:
+        builder = _TARGET_BUILDERS[target.private.protocol]
+    except KeyError:
         raise UnsupportedTarget
+    return builder(target, recipe_bakery, recipe_name, secrets, extension, repository)
+
+
+@lru_cache(maxsize=32)
+def _scheduler_pod_template(image: str):
+    scheduler_spec = make_pod_spec(
+        image=image,
+        labels={"Project": "pangeo-forge"},
+        memory_request="10000Mi",
+        cpu_request="2048m",
+    )
+    scheduler_spec.spec.containers[0].args = ["dask-scheduler"]
+    return clean_pod_template(scheduler_spec, pod_type="scheduler")
+
+
+@lru_cache(maxsize=32)
+def _worker_pod_template(image: str, cpu: int, memory: int, connection_string: str):
+    return make_pod_spec(
+        image=image,
+        labels={"Project": "pangeo-forge"},
+        memory_request=f"{memory}Mi",
+        cpu_request=f"{cpu}m",
+        env={"AZURE_STORAGE_CONNECTION_STRING": connection_string},
+    )
+
+
+def _with_recipe_label(pod_template, recipe_name: str):
+    pod_template = copy.deepcopy(pod_template)
+    pod_template.metadata.labels["Recipe"] = recipe_name
+    return pod_template
+
+
+def _fargate_dask_executor(
+    cluster: Cluster,
+    recipe_bakery: RecipeBakery,
+    recipe_name: str,
+    secrets: ResolvedSecrets,
+):
+    worker_cpu = recipe_bakery.resources.cpu if recipe_bakery.resources is not None else 1024
+    worker_mem = recipe_bakery.resources.memory if recipe_bakery.resources is not None else 4096
+    dask_executor = DaskExecutor(
+        cluster_class="dask_cloudprovider.aws.FargateCluster",
+        cluster_kwargs={
+            "image": cluster.worker_image,
+            "vpc": cluster.cluster_options.vpc,
+            "cluster_arn": cluster.cluster_options.cluster_arn,
+            "task_role_arn": cluster.cluster_options.task_role_arn,
+            "execution_role_arn": cluster.cluster_options.execution_role_arn,
+            "security_groups": cluster.cluster_options.security_groups,
+            "scheduler_cpu": 2048,
+            "scheduler_mem": 16384,
+            "worker_cpu": worker_cpu,
+            "worker_mem": worker_mem,
+            "scheduler_timeout": "15 minutes",
+            "environment": {
+                "PREFECT__LOGGING__EXTRA_LOGGERS": "['pangeo_forge_recipes']",
+                "MALLOC_TRIM_THRESHOLD_": "0",
+            },
+            "tags": {
+                "Project": "pangeo-forge",
+                "Recipe": recipe_name,
+            },
+        },
+        adapt_kwargs={"minimum": 5, "maximum": cluster.max_workers},
+    )
+    return dask_executor
+
+
+def _aks_dask_executor(
+    cluster: Cluster,
+    recipe_bakery: RecipeBakery,
+    recipe_name: str,
+    secrets: ResolvedSecrets,
+):
+    worker_cpu = recipe_bakery.resources.cpu if recipe_bakery.resources is not None else 250
+    worker_mem = recipe_bakery.resources.memory if recipe_bakery.resources is not None else 512
+    scheduler_pod_template = _scheduler_pod_template(cluster.worker_image)
+    worker_pod_template = _worker_pod_template(
+        cluster.worker_image,
+        worker_cpu,
+        worker_mem,
+        secrets.flow_storage_secret,
+    )
+    dask_executor = DaskExecutor(
+        cluster_class="dask_kubernetes.KubeCluster",
+        cluster_kwargs={
+            "pod_template": _with_recipe_label(worker_pod_template, recipe_name),
+            "scheduler_pod_template": _with_recipe_label(scheduler_pod_template, recipe_name),
+        },
+        adapt_kwargs={"minimum": 5, "maximum": cluster.max_workers},
+    )
+    return dask_executor
+
+
+_EXECUTOR_BUILDERS = {
+    FARGATE_CLUSTER: _fargate_dask_executor,
+    AKS_CLUSTER: _aks_dask_executor,
+}
 
 
 def configure_dask_executor(
-    cluster: Cluster, recipe_bakery: RecipeBakery, recipe_name: str, secrets: Dict
+    cluster: Cluster,
+    recipe_bakery: RecipeBakery,
+    recipe_name: str,
+    secrets: ResolvedSecrets,
 ):
-    if cluster.type == FARGATE_CLUSTER:
-        worker_cpu = recipe_bakery.resources.cpu if recipe_bakery.resources is not None else 1024
-        worker_mem = recipe_bakery.resources.memory if recipe_bakery.resources is not None else 4096
-        dask_executor = DaskExecutor(
-            cluster_class="dask_cloudprovider.aws.FargateCluster",
-            cluster_kwargs={
-                "image": cluster.worker_image,
-                "vpc": cluster.cluster_options.vpc,
-                "cluster_arn": cluster.cluster_options.cluster_arn,
-                "task_role_arn": cluster.cluster_options.task_role_arn,
-                "execution_role_arn": cluster.cluster_options.execution_role_arn,
-                "security_groups": cluster.cluster_options.security_groups,
-                "scheduler_cpu": 2048,
-                "scheduler_mem": 16384,
-                "worker_cpu": worker_cpu,
-                "worker_mem": worker_mem,
-                "scheduler_timeout": "15 minutes",
-                "environment": {
-                    "PREFECT__LOGGING__EXTRA_LOGGERS": "['pangeo_forge_recipes']",
-                    "MALLOC_TRIM_THRESHOLD_": "0",
-                },
-                "tags": {
-                    "Project": "pangeo-forge",
-                    "Recipe": recipe_name,
-                },
-            },
-            adapt_kwargs={"minimum": 5, "maximum": cluster.max_workers},
-        )
-        return dask_executor
-    elif cluster.type == AKS_CLUSTER:
-        worker_cpu = recipe_bakery.resources.cpu if recipe_bakery.resources is not None else 250
-        worker_mem = recipe_bakery.resources.memory if recipe_bakery.resources is not None else 512
-        scheduler_spec = make_pod_spec(
-            image=cluster.worker_image,
-            labels={"Recipe": recipe_name, "Project": "pangeo-forge"},
-            memory_request="10000Mi",
-            cpu_request="2048m",
-        )
-        scheduler_spec.spec.containers[0].args = ["dask-scheduler"]
-        scheduler_spec = clean_pod_template(scheduler_spec, pod_type="scheduler")
-        dask_executor = DaskExecutor(
-            cluster_class="dask_kubernetes.KubeCluster",
-            cluster_kwargs={
-                "pod_template": make_pod_spec(
-                    image=cluster.worker_image,
-                    labels={"Recipe": recipe_name, "Project": "pangeo-forge"},
-                    memory_request=f"{worker_mem}Mi",
-                    cpu_request=f"{worker_cpu}m",
-                    env={
-                        "AZURE_STORAGE_CONNECTION_STRING": secrets[
-                            cluster.flow_storage_options.secret
-                        ]
-                    },
-                ),
-                "scheduler_pod_template": scheduler_spec,
-            },
-            adapt_kwargs={"minimum": 5, "maximum": cluster.max_workers},
-        )
-        return dask_executor
-    else:
+    try:
+        builder = _EXECUTOR_BUILDERS[cluster.type]
+    except KeyError:
         raise UnsupportedClusterType
+    return builder(cluster, recipe_bakery, recipe_name, secrets)
+
+
+def _fargate_run_config(
+    cluster: Cluster, recipe_bakery: RecipeBakery, recipe_name: str, secrets: ResolvedSecrets
+):
+    definition = {
+        "networkMode": "awsvpc",
+        "cpu": 2048,
+        "memory": 16384,
+        "containerDefinitions": [{"name": "flow"}],
+        "executionRoleArn": cluster.cluster_options.execution_role_arn,
+    }
+    run_config = ECSRun(
+        image=cluster.worker_image,
+        labels=[recipe_bakery.id],
+        task_definition=definition,
+        run_task_kwargs={
+            "tags": [
+                {"key": "Project", "value": "pangeo-forge"},
+                {"key": "Recipe", "value": recipe_name},
+            ]
+        },
+    )
+    return run_config
+
+
+def _aks_run_config(
+    cluster: Cluster, recipe_bakery: RecipeBakery, recipe_name: str, secrets: ResolvedSecrets
+):
+    job_template = copy.deepcopy(_AKS_JOB_TEMPLATE)
+    run_config = KubernetesRun(
+        job_template=job_template,
+        image=cluster.worker_image,
+        labels=[recipe_bakery.id],
+        memory_request="10000Mi",
+        cpu_request="2048m",
+        env={"AZURE_STORAGE_CONNECTION_STRING": secrets.flow_storage_secret},
+    )
+    return run_config
+
+
+_RUN_CONFIG_BUILDERS = {
+    FARGATE_CLUSTER: _fargate_run_config,
+    AKS_CLUSTER: _aks_run_config,
+}
 
 
 def configure_run_config(
-    cluster: Cluster, recipe_bakery: RecipeBakery, recipe_name: str, secrets: Dict
+    cluster: Cluster, recipe_bakery: RecipeBakery, recipe_name: str, secrets: ResolvedSecrets
 ):
-    if cluster.type == FARGATE_CLUSTER:
-        definition = {
-            "networkMode": "awsvpc",
-            "cpu": 2048,
-            "memory": 16384,
-            "containerDefinitions": [{"name": "flow"}],
-            "executionRoleArn": cluster.cluster_options.execution_role_arn,
-        }
-        run_config = ECSRun(
-            image=cluster.worker_image,
-            labels=[recipe_bakery.id],
-            task_definition=definition,
-            run_task_kwargs={
-                "tags": [
-                    {"key": "Project", "value": "pangeo-forge"},
-                    {"key": "Recipe", "value": recipe_name},
-                ]
-            },
-        )
-        return run_config
-    elif cluster.type == AKS_CLUSTER:
-        job_template = yaml.safe_load(
-            """
-            apiVersion: batch/v1
-            kind: Job
-            metadata:
-              annotations:
-                "cluster-autoscaler.kubernetes.io/safe-to-evict": "false"
-            spec:
-              template:
-                spec:
-                  containers:
-                    - name: flow
-            """
-        )
-        run_config = KubernetesRun(
-            job_template=job_template,
-            image=cluster.worker_image,
-            labels=[recipe_bakery.id],
-            memory_request="10000Mi",
-            cpu_request="2048m",
-            env={"AZURE_STORAGE_CONNECTION_STRING": secrets[cluster.flow_storage_options.secret]},
-        )
-        return run_config
-    else:
+    try:
+        builder = _RUN_CONFIG_BUILDERS[cluster.type]
+    except KeyError:
         raise UnsupportedClusterType
+    return builder(cluster, recipe_bakery, recipe_name, secrets)
 
 
-def configure_flow_storage(cluster: Cluster, secrets):
-    if cluster.flow_storage_protocol == S3_PROTOCOL:
-        key = secrets[cluster.flow_storage_options.key]
-        secret = secrets[cluster.flow_storage_options.secret]
-        flow_storage = storage.S3(
-            bucket=cluster.flow_storage,
-            client_options={"aws_access_key_id": key, "aws_secret_access_key": secret},
-        )
-        return flow_storage
-    elif cluster.flow_storage_protocol == ABFS_PROTOCOL:
-        secret = secrets[cluster.flow_storage_options.secret]
-        flow_storage = storage.Azure(container=cluster.flow_storage, connection_string=secret)
-        return flow_storage
-    else:
+def _s3_flow_storage(cluster: Cluster, secrets: ResolvedSecrets):
+    flow_storage = storage.S3(
+        bucket=cluster.flow_storage,
+        client_options={
+            "aws_access_key_id": secrets.flow_storage_key,
+            "aws_secret_access_key": secrets.flow_storage_secret,
+        },
+    )
+    return flow_storage
+
+
+def _abfs_flow_storage(cluster: Cluster, secrets: ResolvedSecrets):
+    flow_storage = storage.Azure(
+        container=cluster.flow_storage, connection_string=secrets.flow_storage_secret
+    )
+    return flow_storage
+
+
+_FLOW_STORAGE_BUILDERS = {
+    S3_PROTOCOL: _s3_flow_storage,
+    ABFS_PROTOCOL: _abfs_flow_storage,
+}
+
+
+def configure_flow_storage(cluster: Cluster, secrets: ResolvedSecrets):
+    try:
+        builder = _FLOW_STORAGE_BUILDERS[cluster.flow_storage_protocol]
+    except KeyError:
         raise UnsupportedFlowStorage
+    return builder(cluster, secrets)
 
 
 def check_versions(meta: Meta, cluster: Cluster, versions: Versions):
-    if meta.pangeo_notebook_version != versions.pangeo_notebook_version:
-        raise UnsupportedPangeoVersion
-    elif meta.pangeo_notebook_version != cluster.pangeo_notebook_version:
-        raise UnsupportedPangeoVersion
-    elif meta.pangeo_forge_version != versions.pangeo_forge_version:
-        raise UnsupportedPangeoForgeRecipeVersion
-    elif meta.pangeo_forge_version != cluster.pangeo_forge_version:
-        raise UnsupportedPangeoForgeRecipeVersion
-    elif versions.prefect_version != cluster.prefect_version:
-        raise UnsupportedPrefectVersion
-    else:
-        return True
+    checks = (
+        (meta.pangeo_notebook_version, versions.pangeo_notebook_version, UnsupportedPangeoVersion),
+        (meta.pangeo_notebook_version, cluster.pangeo_notebook_version, UnsupportedPangeoVersion),
+        (
+            meta.pangeo_forge_version,
+            versions.pangeo_forge_version,
+            UnsupportedPangeoForgeRecipeVersion,
+        ),
+        (
+            meta.pangeo_forge_version,
+            cluster.pangeo_forge_version,
+            UnsupportedPangeoForgeRecipeVersion,
+        ),
+        (versions.prefect_version, cluster.prefect_version, UnsupportedPrefectVersion),
+    )
+    for required, available, exception in checks:
+        if required != available:
+            raise exception
+    return True
+
+
+@lru_cache(maxsize=None)
+def _load_module(module_path: str):
+    module_name = os.path.splitext(os.path.basename(module_path))[0]
+    spec = importlib.util.spec_from_file_location(module_name, module_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
 
 
 def get_module_attribute(meta_path: str, attribute_path: str):
@@ -273,10 +466,7 @@ def get_module_attribute(meta_path: str, attribute_path: str):
 
     meta_dir = os.path.dirname(os.path.abspath(meta_path))
     module_path = os.path.join(meta_dir, module)
-    spec = importlib.util.spec_from_file_location(name, module_path)
-    module = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(module)
-    return getattr(module, name)
+    return getattr(_load_module(module_path), name)
 
 
 def get_target_extension(recipe: BaseRecipe) -> str:
@@ -292,7 +482,7 @@ def recipe_to_flow(
     recipe_id: str,
     recipe: BaseRecipe,
     targets: Targets,
-    secrets: Dict,
+    secrets: ResolvedSecrets,
     prune: bool = False,
 ):
     recipe.target = targets.target
@@ -309,17 +499,67 @@ def recipe_to_flow(
     flow.executor = dask_executor
     delta = timedelta(minutes=3)
 
+    # Defined as a closure so cloudpickle serializes it by value: the flow is
+    # unpickled on bakery images which don't have pangeo_forge_prefect installed.
+    def configure_recipe_logging(task, old_state, new_state):
+        recipe_logger = logging.getLogger("pangeo_forge_recipes")
+        if recipe_logger.level != logging.DEBUG:
+            logging.basicConfig()
+            recipe_logger.setLevel(level=logging.DEBUG)
+        return new_state
+
     for flow_task in flow.tasks:
         flow_task.max_retries = 3
         flow_task.retry_delay = delta
-        flow_task.run = set_log_level(flow_task.run)
+        flow_task.state_handlers = [*flow_task.state_handlers, configure_recipe_logging]
 
     flow.name = recipe_id
     return flow
 
 
+@lru_cache(maxsize=1)
+def _get_prefect_client() -> client.Client:
+    return client.Client()
+
+
+def create_flow_runs(prefect_client: client.Client, flow_ids: List[str], run_name: str):
+    """
+    Create a flow run for each of the flows in a single GraphQL request.
+
+    Parameters
+    ----------
+    prefect_client : prefect.client.Client
+        The client used to submit the mutation
+    flow_ids : list of str
+        The ids of the registered flows
+    run_name : str
+        The name given to each of the flow runs
+
+    Returns
+    -------
+    list of str
+        The ids of the created flow runs, in the same order as flow_ids
+    """
+    create_flow_runs_mutation = {
+        "mutation": {
+            with_args(
+                f"flow_run_{index}: create_flow_run",
+                {"input": {"flow_id": flow_id, "flow_run_name": run_name}},
+            ): {"id"}
+            for index, flow_id in enumerate(flow_ids)
+        }
+    }
+    response = prefect_client.graphql(create_flow_runs_mutation)
+    return [response["data"][f"flow_run_{index}"]["id"] for index in range(len(flow_ids))]
+
+
 def register_flow(
-    meta_path: str, bakeries_path: str, secrets: Dict, versions: Versions, prune: bool = False
+    meta_path: str,
+    bakeries_path: str,
+    secrets: Dict,
+    versions: Versions,
+    prune: bool = False,
+    max_workers: Optional[int] = None,
 ):
     """
     Convert a pangeo-forge to a Prefect recipe and register with Prefect Cloud.
@@ -329,6 +569,10 @@ def register_flow(
     storage, dask cluster and parameters for a Prefect flow and registers this
     flow with a Prefect Cloud account.
 
+    Every recipe is attempted even if another fails to register. Flow runs
+    and automations are still created for the flows that did register, each
+    failure is logged with its recipe id and the first error is then raised.
+
     Parameters
     ----------
     meta_path : str
@@ -336,38 +580,59 @@ def register_flow(
     bakeries_path : str
         Path to a bakeries.yaml file containing an entry for the recipe's
         bakery.id
+    max_workers : int, optional
+        Maximum number of flows to configure and register concurrently.
+        Defaults to the ThreadPoolExecutor default.
     """
-    with open(meta_path) as meta_yaml, open(bakeries_path) as bakeries_yaml:
-        meta_dict = yaml.load(meta_yaml, Loader=yaml.FullLoader)
-        meta = from_dict(data_class=Meta, data=meta_dict)
-
-        bakeries_dict = yaml.load(bakeries_yaml, Loader=yaml.FullLoader)
-        bakery = from_dict(data_class=Bakery, data=bakeries_dict[meta.bakery.id])
-
-        check_versions(meta, bakery.cluster, versions)
-        project_name = os.environ["PREFECT_PROJECT_NAME"]
-        comment_id = os.getenv("COMMENT_ID")
-        prefect_client = client.Client()
-
-        for recipe_meta in meta.recipes:
-            if recipe_meta.dict_object:
-                recipes_dict = get_module_attribute(meta_path, recipe_meta.dict_object)
-                for key, value in recipes_dict.items():
-                    extension = get_target_extension(value)
-                    targets = configure_targets(bakery, meta.bakery, key, secrets, extension)
-                    flow = recipe_to_flow(bakery, meta, key, value, targets, secrets, prune)
-                    flow_id = flow.register(project_name=project_name)
-                    if comment_id:
-                        prefect_client.create_flow_run(flow_id=flow_id, run_name=comment_id)
-                        pat_token = secrets["ACTIONS_BOT_TOKEN"]
-                        create_automation(flow_id, pat_token)
-            else:
-                recipe = get_module_attribute(meta_path, recipe_meta.object)
-                extension = get_target_extension(recipe)
-                targets = configure_targets(bakery, meta.bakery, recipe_meta.id, secrets, extension)
-                flow = recipe_to_flow(bakery, meta, recipe_meta.id, recipe, targets, secrets, prune)
-                flow_id = flow.register(project_name=project_name)
-                if comment_id:
-                    prefect_client.create_flow_run(flow_id=flow_id, run_name=comment_id)
-                    pat_token = secrets["ACTIONS_BOT_TOKEN"]
-                    create_automation(flow_id, pat_token)
+    meta_dict = _load_yaml_cached(meta_path)
+    meta = from_dict(data_class=Meta, data=meta_dict)
+
+    bakery_dict = _load_yaml_cached(bakeries_path, meta.bakery.id)
+    bakery = from_dict(data_class=Bakery, data=bakery_dict)
+
+    check_versions(meta, bakery.cluster, versions)
+    project_name = os.environ["PREFECT_PROJECT_NAME"]
+    repository = os.environ["GITHUB_REPOSITORY"]
+    comment_id = os.getenv("COMMENT_ID")
+    pat_token = secrets["ACTIONS_BOT_TOKEN"] if comment_id else None
+    resolved_secrets = resolve_secrets(bakery, meta.bakery, secrets)
+
+    recipes = []
+    for recipe_meta in meta.recipes:
+        if recipe_meta.dict_object:
+            recipes_dict = get_module_attribute(meta_path, recipe_meta.dict_object)
+            recipes.extend(recipes_dict.items())
+        else:
+            recipe = get_module_attribute(meta_path, recipe_meta.object)
+            recipes.append((recipe_meta.id, recipe))
+
+    def _register_one(recipe_id: str, recipe: BaseRecipe):
+        extension = get_target_extension(recipe)
+        targets = configure_targets(
+            bakery, meta.bakery, recipe_id, resolved_secrets, extension, repository
+        )
+        flow = recipe_to_flow(bakery, meta, recipe_id, recipe, targets, resolved_secrets, prune)
+        return flow.register(project_name=project_name)
+
+    # Recipe modules are memoized, so each submission gets its own copy of the
+    # recipe to set targets on.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(_register_one, recipe_id, copy.deepcopy(recipe))
+            for recipe_id, recipe in recipes
+        ]
+        flow_ids = []
+        errors = []
+        for (recipe_id, _), future in zip(recipes, futures):
+            try:
+                flow_ids.append(future.result())
+            except Exception as error:
+                logger.error("Failed to register flow for recipe %s", recipe_id, exc_info=error)
+                errors.append(error)
+
+    if comment_id and flow_ids:
+        create_flow_runs(_get_prefect_client(), flow_ids, comment_id)
+        for flow_id in flow_ids:
+            create_automation(flow_id, pat_token)
+    if errors:
+        raise errors[0]
@@ -15,6 +15,6 @@ setup(
     ],
     extras_require={
         "dev": ["flake8", "black", "pre-commit", "pre-commit-hooks", "isort", "pytest"],
-        "test": ["flake8", "pytest"],
+        "test": ["flake8", "pytest", "cloudpickle"],
     },
 )
@@ -1,7 +1,12 @@
+import io
+import logging
 import os
 import pathlib
+import pickle
+from datetime import timedelta
 from unittest.mock import Mock, call, patch
 
+import cloudpickle
 import fsspec
 import pytest
 import yaml
@@ -14,20 +19,28 @@ from prefect.core import Flow
 from prefect.run_configs import ECSRun, KubernetesRun
 
 from pangeo_forge_prefect.flow_manager import (
+    ResolvedSecrets,
     Targets,
     UnsupportedClusterType,
     UnsupportedFlowStorage,
     UnsupportedPangeoVersion,
+    UnsupportedPrefectVersion,
     UnsupportedRecipeType,
     UnsupportedTarget,
+    _load_yaml_cached,
+    _scheduler_pod_template,
+    _worker_pod_template,
     check_versions,
     configure_dask_executor,
     configure_flow_storage,
     configure_run_config,
     configure_targets,
+    create_flow_runs,
     get_module_attribute,
     get_target_extension,
     recipe_to_flow,
+    register_flow,
+    resolve_secrets,
 )
 from pangeo_forge_prefect.meta_types.bakery import Bakery
 from pangeo_forge_prefect.meta_types.meta import Meta
@@ -110,6 +123,16 @@ def secrets():
     return secret_values
 
 
+@pytest.fixture
+def aws_secrets(aws_bakery, meta_aws, secrets):
+    return resolve_secrets(aws_bakery, meta_aws.bakery, secrets)
+
+
+@pytest.fixture
+def azure_secrets(azure_bakery, meta_azure, secrets):
+    return resolve_secrets(azure_bakery, meta_azure.bakery, secrets)
+
+
 @pytest.fixture()
 def tmp_target(tmpdir_factory):
     fs = fsspec.get_filesystem_class("file")()
@@ -133,10 +156,24 @@ def tmp_metadata(tmpdir_factory):
     return metadata
 
 
+def test_resolve_secrets(aws_bakery, meta_aws, azure_bakery, meta_azure, secrets):
+    aws_secrets = resolve_secrets(aws_bakery, meta_aws.bakery, secrets)
+    assert aws_secrets == ResolvedSecrets(
+        target_key=key,
+        target_secret=secret,
+        flow_storage_key=key,
+        flow_storage_secret=secret,
+    )
+    azure_secrets = resolve_secrets(azure_bakery, meta_azure.bakery, secrets)
+    assert azure_secrets == ResolvedSecrets(target_secret=secret, flow_storage_secret=secret)
+    with pytest.raises(KeyError):
+        resolve_secrets(aws_bakery, meta_aws.bakery, {})
+
+
 @patch.dict(os.environ, {"GITHUB_REPOSITORY": "pangeo-forge/staged-recipes"})
 @patch("pangeo_forge_prefect.flow_manager.S3FileSystem")
-def test_configure_targets_aws(S3FileSystem, aws_bakery, meta_aws, secrets):
-    targets = configure_targets(aws_bakery, meta_aws.bakery, recipe_name, secrets, extension)
+def test_configure_targets_aws(S3FileSystem, aws_bakery, meta_aws, aws_secrets):
+    targets = configure_targets(aws_bakery, meta_aws.bakery, recipe_name, aws_secrets, extension)
     S3FileSystem.assert_called_once_with(
         anon=False,
         default_cache_type="none",
@@ -151,123 +188,161 @@ def test_configure_targets_aws(S3FileSystem, aws_bakery, meta_aws, secrets):
         "pangeo-forge-aws-bakery-flowcachebucketdasktest4-10neo67y7a924"
     ].private.protocol = "GCS"
     with pytest.raises(UnsupportedTarget):
-        configure_targets(aws_bakery, meta_aws.bakery, recipe_name, secrets, extension)
+        configure_targets(aws_bakery, meta_aws.bakery, recipe_name, aws_secrets, extension)
 
 
 @patch.dict(os.environ, {"GITHUB_REPOSITORY": "pangeo-forge/staged-recipes"})
 @patch("pangeo_forge_prefect.flow_manager.AzureBlobFileSystem")
-def test_configure_targets_azure(AzureBlobFileSystem, azure_bakery, meta_azure, secrets):
-    targets = configure_targets(azure_bakery, meta_azure.bakery, recipe_name, secrets, extension)
+def test_configure_targets_azure(AzureBlobFileSystem, azure_bakery, meta_azure, azure_secrets):
+    targets = configure_targets(
+        azure_bakery, meta_azure.bakery, recipe_name, azure_secrets, extension
+    )
     AzureBlobFileSystem.assert_called_once_with(
         connection_string=secret,
     )
     assert targets.target.root_path == (
         f"abfs://{meta_azure.bakery.target}/pangeo-forge/staged-recipes/{recipe_name}.zarr"
     )
+    assert targets.cache.root_path == (
+        f"abfs://{meta_azure.bakery.target}/pangeo-forge/staged-recipes/{recipe_name}/cache"
+    )
+    assert targets.metadata.root_path == (
+        f"abfs://{meta_azure.bakery.target}/pangeo-forge/staged-recipes/{recipe_name}"
+        "/cache/metadata"
+    )
     azure_bakery.targets["test-bakery-flow-cache-container"].private.protocol = "GCS"
     with pytest.raises(UnsupportedTarget):
-        configure_targets(azure_bakery, meta_azure.bakery, recipe_name, secrets, extension)
+        configure_targets(azure_bakery, meta_azure.bakery, recipe_name, azure_secrets, extension)
 
 
 @patch("pangeo_forge_prefect.flow_manager.storage")
-def test_configure_flow_storage_aws(storage, aws_bakery, secrets):
-    configure_flow_storage(aws_bakery.cluster, secrets)
+def test_configure_flow_storage_aws(storage, aws_bakery, aws_secrets):
+    configure_flow_storage(aws_bakery.cluster, aws_secrets)
     storage.S3.assert_called_once_with(
         bucket=aws_bakery.cluster.flow_storage,
         client_options={"aws_access_key_id": key, "aws_secret_access_key": secret},
     )
     aws_bakery.cluster.flow_storage_protocol = "GCS"
     with pytest.raises(UnsupportedFlowStorage):
-        configure_flow_storage(aws_bakery.cluster, secrets)
+        configure_flow_storage(aws_bakery.cluster, aws_secrets)
 
 
 @patch("pangeo_forge_prefect.flow_manager.storage")
-def test_configure_flow_storage_azure(storage, azure_bakery, secrets):
-    configure_flow_storage(azure_bakery.cluster, secrets)
+def test_configure_flow_storage_azure(storage, azure_bakery, azure_secrets):
+    configure_flow_storage(azure_bakery.cluster, azure_secrets)
     storage.Azure.assert_called_once_with(
         container=azure_bakery.cluster.flow_storage,
         connection_string=secret,
     )
     azure_bakery.cluster.flow_storage_protocol = "GCS"
     with pytest.raises(UnsupportedFlowStorage):
-        configure_flow_storage(azure_bakery.cluster, secrets)
+        configure_flow_storage(azure_bakery.cluster, azure_secrets)
 
 
 def test_configure_dask_executor_aws(aws_bakery, meta_aws):
     recipe_name = "test"
-    dask_executor = configure_dask_executor(aws_bakery.cluster, meta_aws.bakery, recipe_name, {})
+    dask_executor = configure_dask_executor(
+        aws_bakery.cluster, meta_aws.bakery, recipe_name, ResolvedSecrets()
+    )
     assert dask_executor.cluster_class == FargateCluster
     assert dask_executor.cluster_kwargs["worker_cpu"] == meta_aws.bakery.resources.cpu
     assert dask_executor.cluster_kwargs["worker_mem"] == meta_aws.bakery.resources.memory
     assert dask_executor.adapt_kwargs["maximum"] == aws_bakery.cluster.max_workers
 
     meta_aws.bakery.resources = None
-    dask_executor = configure_dask_executor(aws_bakery.cluster, meta_aws.bakery, recipe_name, {})
+    dask_executor = configure_dask_executor(
+        aws_bakery.cluster, meta_aws.bakery, recipe_name, ResolvedSecrets()
+    )
     # Uses default resource definitions
     assert dask_executor.cluster_kwargs["worker_cpu"] == 1024
     assert dask_executor.cluster_kwargs["worker_mem"] == 4096
     aws_bakery.cluster.type = "New"
     with pytest.raises(UnsupportedClusterType):
         dask_executor = configure_dask_executor(
-            aws_bakery.cluster, meta_aws.bakery, recipe_name, {}
+            aws_bakery.cluster, meta_aws.bakery, recipe_name, ResolvedSecrets()
         )
 
 
 @patch("pangeo_forge_prefect.flow_manager.make_pod_spec")
-def test_configure_dask_executor_azure(make_pod_spec, azure_bakery, meta_azure, secrets):
+def test_configure_dask_executor_azure(make_pod_spec, azure_bakery, meta_azure, azure_secrets):
+    _scheduler_pod_template.cache_clear()
+    _worker_pod_template.cache_clear()
     dask_executor = configure_dask_executor(
-        azure_bakery.cluster, meta_azure.bakery, recipe_name, secrets
+        azure_bakery.cluster, meta_azure.bakery, recipe_name, azure_secrets
     )
     assert dask_executor.cluster_class == KubeCluster
     assert dask_executor.adapt_kwargs["maximum"] == azure_bakery.cluster.max_workers
     worker_call = call(
         image=azure_bakery.cluster.worker_image,
-        labels={"Recipe": recipe_name, "Project": "pangeo-forge"},
+        labels={"Project": "pangeo-forge"},
         memory_request=f"{meta_azure.bakery.resources.memory}Mi",
         cpu_request=f"{meta_azure.bakery.resources.cpu}m",
         env={"AZURE_STORAGE_CONNECTION_STRING": secret},
     )
     scheduler_call = call(
         image=azure_bakery.cluster.worker_image,
-        labels={"Recipe": recipe_name, "Project": "pangeo-forge"},
+        labels={"Project": "pangeo-forge"},
         memory_request="10000Mi",
         cpu_request="2048m",
     )
     make_pod_spec.assert_has_calls([scheduler_call, worker_call], any_order=True)
     make_pod_spec.reset_mock()
 
+    # Templates are reused for recipes sharing the same resources
+    configure_dask_executor(azure_bakery.cluster, meta_azure.bakery, "other", azure_secrets)
+    make_pod_spec.assert_not_called()
+
     meta_azure.bakery.resources = None
     dask_executor = configure_dask_executor(
-        azure_bakery.cluster, meta_azure.bakery, recipe_name, secrets
+        azure_bakery.cluster, meta_azure.bakery, recipe_name, azure_secrets
     )
     worker_call = call(
         image=azure_bakery.cluster.worker_image,
-        labels={"Recipe": recipe_name, "Project": "pangeo-forge"},
+        labels={"Project": "pangeo-forge"},
         memory_request="512Mi",
         cpu_request="250m",
         env={"AZURE_STORAGE_CONNECTION_STRING": secret},
     )
-    make_pod_spec.assert_has_calls([worker_call, scheduler_call], any_order=True)
+    make_pod_spec.assert_called_once_with(**worker_call.kwargs)
 
     azure_bakery.cluster.type = "New"
     with pytest.raises(UnsupportedClusterType):
         dask_executor = configure_dask_executor(
-            azure_bakery.cluster, meta_azure.bakery, recipe_name, {}
+            azure_bakery.cluster, meta_azure.bakery, recipe_name, ResolvedSecrets()
         )
 
 
+def test_configure_dask_executor_azure_labels(azure_bakery, meta_azure, azure_secrets):
+    _scheduler_pod_template.cache_clear()
+    _worker_pod_template.cache_clear()
+    dask_executor = configure_dask_executor(
+        azure_bakery.cluster, meta_azure.bakery, recipe_name, azure_secrets
+    )
+    scheduler_pod_template = _scheduler_pod_template(azure_bakery.cluster.worker_image)
+    scheduler_spec = dask_executor.cluster_kwargs["scheduler_pod_template"]
+    assert scheduler_spec is not scheduler_pod_template
+    assert scheduler_spec.metadata.labels["Recipe"] == recipe_name
+    assert "Recipe" not in scheduler_pod_template.metadata.labels
+    worker_spec = dask_executor.cluster_kwargs["pod_template"]
+    assert worker_spec.metadata.labels["Recipe"] == recipe_name
+
+
 def test_configure_run_config_aws(aws_bakery, meta_aws):
     recipe_name = "test"
-    run_config = configure_run_config(aws_bakery.cluster, meta_aws.bakery, recipe_name, {})
+    run_config = configure_run_config(
+        aws_bakery.cluster, meta_aws.bakery, recipe_name, ResolvedSecrets()
+    )
     assert type(run_config) == ECSRun
     assert meta_aws.bakery.id in run_config.labels
     aws_bakery.cluster.type = "New"
     with pytest.raises(UnsupportedClusterType):
-        configure_run_config(aws_bakery.cluster, meta_aws.bakery, recipe_name, {})
+        configure_run_config(aws_bakery.cluster, meta_aws.bakery, recipe_name, ResolvedSecrets())
 
 
-def test_configure_run_config_azure(azure_bakery, meta_azure, k8s_job_template, secrets):
-    run_config = configure_run_config(azure_bakery.cluster, meta_azure.bakery, recipe_name, secrets)
+def test_configure_run_config_azure(azure_bakery, meta_azure, k8s_job_template, azure_secrets):
+    run_config = configure_run_config(
+        azure_bakery.cluster, meta_azure.bakery, recipe_name, azure_secrets
+    )
     assert type(run_config) == KubernetesRun
     assert meta_azure.bakery.id in run_config.labels
     assert k8s_job_template == run_config.job_template
@@ -277,7 +352,9 @@ def test_configure_run_config_azure(azure_bakery, meta_azure, k8s_job_template,
     assert {"AZURE_STORAGE_CONNECTION_STRING": secret} == run_config.env
     azure_bakery.cluster.type = "New"
     with pytest.raises(UnsupportedClusterType):
-        configure_run_config(azure_bakery.cluster, meta_azure.bakery, recipe_name, {})
+        configure_run_config(
+            azure_bakery.cluster, meta_azure.bakery, recipe_name, ResolvedSecrets()
+        )
 
 
 def test_check_versions(aws_bakery, meta_aws):
@@ -290,6 +367,41 @@ def test_check_versions(aws_bakery, meta_aws):
     versions.pangeo_notebook_version = "none"
     with pytest.raises(UnsupportedPangeoVersion):
         check_versions(meta_aws, aws_bakery.cluster, versions)
+    versions.pangeo_notebook_version = "2021.06.05"
+    versions.prefect_version = "none"
+    with pytest.raises(UnsupportedPrefectVersion):
+        check_versions(meta_aws, aws_bakery.cluster, versions)
+
+
+def test_load_yaml_cached():
+    bakeries_path = f"{os.path.dirname(__file__)}/data/bakeries.yaml"
+    bakeries_dict = _load_yaml_cached(bakeries_path)
+    assert "devseed.bakery.development.aws.us-west-2" in bakeries_dict
+    assert _load_yaml_cached(bakeries_path) is bakeries_dict
+
+    bakery_dict = _load_yaml_cached(bakeries_path, "devseed.bakery.development.azure.ukwest")
+    assert bakery_dict == bakeries_dict["devseed.bakery.development.azure.ukwest"]
+    with pytest.raises(KeyError):
+        _load_yaml_cached(bakeries_path, "missing")
+
+
+def test_load_yaml_cached_rewritten(tmp_path):
+    yaml_path = tmp_path / "meta.yaml"
+    yaml_path.write_text("value: 1")
+    original_stat = os.stat(yaml_path)
+    assert _load_yaml_cached(str(yaml_path)) == {"value": 1}
+
+    # A rewrite within the filesystem's timestamp resolution is still picked up
+    yaml_path.write_text("value: 10")
+    os.utime(yaml_path, ns=(original_stat.st_atime_ns, original_stat.st_mtime_ns))
+    assert _load_yaml_cached(str(yaml_path)) == {"value": 10}
+
+
+def test_load_yaml_cached_duplicate_key(tmp_path):
+    yaml_path = tmp_path / "bakeries.yaml"
+    yaml_path.write_text("bakery:\n  value: first\nbakery: dup\n")
+    assert _load_yaml_cached(str(yaml_path), "bakery") == "dup"
+    assert _load_yaml_cached(str(yaml_path))["bakery"] == "dup"
 
 
 def test_get_module_attribute(meta_aws):
@@ -300,6 +412,7 @@ def test_get_module_attribute(meta_aws):
 
     recipes_dict = get_module_attribute(meta_path, "recipe_dict:recipes")
     assert isinstance(recipes_dict, dict)
+    assert get_module_attribute(meta_path, "recipe_dict:recipes") is recipes_dict
 
 
 def test_get_target_extension():
@@ -311,17 +424,139 @@ def test_get_target_extension():
 
 
 @patch.dict(os.environ, {"PREFECT_PROJECT_NAME": "project"})
-def test_recipe_to_flow(aws_bakery, meta_aws, secrets, tmp_target, tmp_cache, tmp_metadata):
+def test_recipe_to_flow(aws_bakery, meta_aws, aws_secrets, tmp_target, tmp_cache, tmp_metadata):
     meta_path = pathlib.Path(__file__).parent.absolute().joinpath("./data/meta.yaml")
     recipe = get_module_attribute(meta_path, meta_aws.recipes[-1].object)
 
     targets = Targets(target=tmp_target, cache=tmp_cache, metadata=tmp_metadata)
 
-    flow = recipe_to_flow(aws_bakery, meta_aws, "recipe_id", recipe, targets, secrets)
+    flow = recipe_to_flow(aws_bakery, meta_aws, "recipe_id", recipe, targets, aws_secrets)
     assert isinstance(flow, Flow)
+    for flow_task in flow.tasks:
+        assert flow_task.max_retries == 3
+        assert flow_task.retry_delay == timedelta(minutes=3)
+
+    recipe_logger = logging.getLogger("pangeo_forge_recipes")
+    recipe_logger.setLevel(logging.NOTSET)
+    new_state = Mock()
+    for flow_task in flow.tasks:
+        assert flow_task.state_handlers[-1](flow_task, Mock(), new_state) is new_state
+    assert recipe_logger.level == logging.DEBUG
 
     recipe = Mock()
     flow_stub = Mock(tasks=[])
     recipe.copy_pruned().to_prefect.return_value = flow_stub
-    recipe_to_flow(aws_bakery, meta_aws, "recipe_id", recipe, targets, secrets, prune=True)
+    recipe_to_flow(aws_bakery, meta_aws, "recipe_id", recipe, targets, aws_secrets, prune=True)
     recipe.copy_pruned.assert_called_once
+
+
+def test_create_flow_runs():
+    prefect_client = Mock()
+    prefect_client.graphql.return_value = {
+        "data": {"flow_run_0": {"id": "run-a"}, "flow_run_1": {"id": "run-b"}}
+    }
+    flow_run_ids = create_flow_runs(prefect_client, ["flow-a", "flow-b"], "comment")
+    assert flow_run_ids == ["run-a", "run-b"]
+    prefect_client.graphql.assert_called_once()
+    mutation = prefect_client.graphql.call_args[0][0]["mutation"]
+    assert len(mutation) == 2
+    assert all("create_flow_run" in field for field in mutation)
+
+
+@patch.dict(
+    os.environ,
+    {
+        "PREFECT_PROJECT_NAME": "project",
+        "GITHUB_REPOSITORY": "pangeo-forge/staged-recipes",
+        "COMMENT_ID": "comment",
+    },
+)
+@patch("pangeo_forge_prefect.flow_manager.create_automation")
+@patch("pangeo_forge_prefect.flow_manager.create_flow_runs")
+@patch("pangeo_forge_prefect.flow_manager._get_prefect_client")
+@patch("pangeo_forge_prefect.flow_manager.recipe_to_flow")
+@patch("pangeo_forge_prefect.flow_manager.configure_targets")
+@patch("pangeo_forge_prefect.flow_manager.get_target_extension")
+@patch("pangeo_forge_prefect.flow_manager.get_module_attribute")
+def test_register_flow(
+    get_module_attribute,
+    get_target_extension,
+    configure_targets,
+    recipe_to_flow,
+    _get_prefect_client,
+    create_flow_runs,
+    create_automation,
+    secrets,
+    tmp_path,
+    caplog,
+):
+    with open(f"{os.path.dirname(__file__)}/data/meta_aws.yaml") as meta_yaml:
+        meta_dict = yaml.safe_load(meta_yaml)
+    meta_dict["recipes"] = [{"dict_object": "recipe_dict:recipes"}]
+    meta_path = tmp_path / "meta.yaml"
+    meta_path.write_text(yaml.safe_dump(meta_dict))
+    bakeries_path = f"{os.path.dirname(__file__)}/data/bakeries.yaml"
+    versions = Versions(
+        pangeo_notebook_version="2021.06.05",
+        pangeo_forge_version="0.4.0",
+        prefect_version="0.14.22",
+    )
+
+    recipe = {"shared": True}
+    get_module_attribute.return_value = {"good": recipe, "bad": recipe, "worse": recipe}
+    received_recipes = []
+
+    def to_flow(bakery, meta, recipe_id, recipe, *args):
+        received_recipes.append(recipe)
+        if recipe_id in ("bad", "worse"):
+            raise ValueError(recipe_id)
+        return Mock(register=Mock(return_value="flow-good"))
+
+    recipe_to_flow.side_effect = to_flow
+    with pytest.raises(ValueError):
+        register_flow(
+            str(meta_path), bakeries_path, {**secrets, "ACTIONS_BOT_TOKEN": "token"}, versions
+        )
+
+    # Each registration works on its own copy of the shared recipe object
+    assert len(received_recipes) == 3
+    assert len({id(received) for received in received_recipes}) == 3
+    assert all(received is not recipe for received in received_recipes)
+    # Flows that registered still get their runs and automations
+    create_flow_runs.assert_called_once_with(
+        _get_prefect_client.return_value, ["flow-good"], "comment"
+    )
+    create_automation.assert_called_once_with("flow-good", "token")
+    # Every failed registration is logged, not just the one raised
+    failures = [record.getMessage() for record in caplog.records if record.levelname == "ERROR"]
+    assert failures == [
+        "Failed to register flow for recipe bad",
+        "Failed to register flow for recipe worse",
+    ]
+
+
+class RecordingUnpickler(pickle.Unpickler):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.modules = set()
+
+    def find_class(self, module, name):
+        self.modules.add(module)
+        return super().find_class(module, name)
+
+
+@patch.dict(os.environ, {"PREFECT_PROJECT_NAME": "project"})
+def test_recipe_to_flow_pickles_by_value(
+    aws_bakery, meta_aws, aws_secrets, tmp_target, tmp_cache, tmp_metadata
+):
+    meta_path = pathlib.Path(__file__).parent.absolute().joinpath("./data/meta.yaml")
+    recipe = get_module_attribute(meta_path, meta_aws.recipes[-1].object)
+    targets = Targets(target=tmp_target, cache=tmp_cache, metadata=tmp_metadata)
+    flow = recipe_to_flow(aws_bakery, meta_aws, "recipe_id", recipe, targets, aws_secrets)
+
+    # Bakery images don't install pangeo_forge_prefect, so unpickling the flow
+    # must not import anything from it.
+    unpickler = RecordingUnpickler(io.BytesIO(cloudpickle.dumps(flow)))
+    unpickler.load()
+    assert unpickler.modules
+    assert not any(module.startswith("pangeo_forge_prefect") for module in unpickler.modules)